@@ -80,6 +80,9 @@ to use:
         if self._width < 1 or self._height < 1:
             raise EPDError('invalid panel geometry')
 
+        self._display_path = os.path.join(self._epd_path, 'LE', 'display_inverse')
+        self._command_path = os.path.join(self._epd_path, 'command')
+
 
     @property
     def size(self):
@@ -135,7 +138,7 @@ to use:
         if image.size != self.size:
             raise EPDError('image size mismatch')
 
-        with open(os.path.join(self._epd_path, 'LE', 'display_inverse'), 'r+b') as f:
+        with open(self._display_path, 'r+b') as f:
             f.write(image.tobytes())
 
         if self.auto:
@@ -152,5 +155,5 @@ to use:
         self._command('C')
 
     def _command(self, c):
-        with open(os.path.join(self._epd_path, 'command'), 'wb') as f:
+        with open(self._command_path, 'wb') as f:
             f.write(bytes(c, 'UTF-8'))
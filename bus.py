@@ -4,20 +4,37 @@
 WHITE = 1
 BLACK = 0
 
+# Number of pixels that can change through partial updates before a full
+# update is done to clear any ghosting left behind on the panel
+EINK_PARTIAL_ERASURE_LIMIT = 20000
+
+# Returned by fetchBusJSON() when TfL reports the data hasn't changed
+NOT_MODIFIED = object()
+
 import argparse
+import asyncio
+import concurrent.futures
 import datetime
-import json
 import logging
 import sys
 import time
 
-import iso8601
+import aiohttp
+import orjson
 import PIL
-import requests
 
-from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from EPD import EPD
-from PIL import ImageFont, ImageDraw
+from PIL import ImageChops, ImageDraw, ImageFont
+
+try:
+    from ciso8601 import parse_datetime as parse_iso8601
+except ImportError:
+    def parse_iso8601(dateString):
+        """Parse an ISO 8601 timestamp, as returned by TfL"""
+        # fromisoformat() only accepts a trailing Z from Python 3.11 onwards
+        return datetime.datetime.fromisoformat(dateString.replace("Z",
+                                                                  "+00:00"))
 
 
 def parse_options(args=None):
@@ -45,31 +62,42 @@ class PiBus:
     currentJSON = None
     logger = None
     session = None
+    fetchTask = None
+    renderExecutor = None
     fontTiny = None
     fontMedium = None
     fontLarge = None
     fontHuge = None
     panel = None
-    partialCount = None
+    partialErasure = None
+    lastImage = None
     lastFetchTime = None
+    lastFetchAttempt = None
     renderSuspended = None
+    etag = None
+    lastModified = None
+    dividerLines = None
+    blankImage = None
+    image = None
+    busLineLabel = None
+    fetchedLabel = None
+    fetchedLabelWidth = None
 
     def __init__(self, options, scheduler):
         self.options = options
         self.scheduler = scheduler
         self.logger = logging.getLogger("PiBus")
-        self.session = requests.Session()
 
         if options.debug:
             self.logger.setLevel(logging.DEBUG)
 
-        self.logger.debug("Command line options: %s" % self.options)
+        self.logger.debug("Command line options: %s", self.options)
 
         if not self.options.busStopID or not self.options.busLine:
             self.logger.error("You must provide both bus stop and bus route")
             sys.exit(1)
 
-        self.partialCount = 0
+        self.partialErasure = 0
         self.renderSuspended = False
 
         self.fontTiny = ImageFont.truetype("font.ttf", size=10)
@@ -77,21 +105,51 @@ class PiBus:
         self.fontLarge = ImageFont.truetype("font.ttf", size=75)
         self.fontHuge = ImageFont.truetype("font.ttf", size=150)
 
+        # These labels never change, so only rasterise them once
+        self.busLineLabel = self.renderLabel(self.options.busLine,
+                                             self.fontTiny)
+        self.fetchedLabel = self.renderLabel("Fetched: ", self.fontTiny)
+        self.fetchedLabelWidth = int(self.fontTiny.getlength("Fetched: "))
+
         try:
             self.panel = EPD()
 
-            self.logger.debug("Panel: {w:d}x{h:d}".format(w=self.panel.width,
-                                                          h=self.panel.height))
+            self.logger.debug("Panel: %dx%d", self.panel.width,
+                              self.panel.height)
+
+            # The layout never changes, so work out the geometry once
+            width, height = self.panel.size
+            divX = int(width * 0.66)
+            divY = int(height * 0.5)
+            self.dividerLines = [((divX, 0), (divX, height)),
+                                 ((divX, divY), (width, divY))]
+
+            # Every frame starts as a box drawn around the edge of the screen,
+            # the first argument means we get a 1 bit depth
+            self.blankImage = PIL.Image.new('1', self.panel.size, WHITE)
+            draw = ImageDraw.Draw(self.blankImage)
+            for borderLine in [((0, 0), (width, 0)),
+                               ((0, 0), (0, height)),
+                               ((width - 1, 0), (width - 1, height)),
+                               ((0, height - 1), (width - 1, height - 1))]:
+                draw.line(borderLine, fill=BLACK, width=1)
+            self.image = self.blankImage.copy()
         except Exception as e:
             self.panel = None
-            self.logger.warn("No panel found: %s" % e)
+            self.logger.warning("No panel found: %s", e)
 
-        self.scheduler.add_job(self.updateBusInfo,
-                               trigger='interval',
-                               seconds=30,
-                               next_run_time=datetime.datetime.now(),
-                               max_instances=1)
-        self.scheduler.add_job(self.renderBusInfo,
+        # Without a panel there is nothing to render to, so don't keep
+        # scheduling a job that can only fail
+        if not self.panel:
+            self.logger.error("Not scheduling updates without a panel")
+            return
+
+        # All drawing and panel I/O happens on this one thread, away from
+        # both the event loop and the default executor aiohttp resolves on
+        self.renderExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+
+        self.scheduler.add_job(self.tick,
                                trigger='interval',
                                seconds=10,
                                next_run_time=datetime.datetime.now(),
@@ -99,38 +157,97 @@ class PiBus:
 
     def prettifyJSON(self, jsonText):
         """Neatly format JSON to make it human readable"""
-        return json.dumps(jsonText, sort_keys=True, indent=4,
-                          separators=(',', ': '))
+        return orjson.dumps(jsonText,
+                            option=orjson.OPT_INDENT_2 |
+                            orjson.OPT_SORT_KEYS).decode()
+
+    def renderLabel(self, text, font):
+        """Rasterise a piece of static text into a mask for pasting"""
+        # The glyphs are set and everything else is clear, so that pasting
+        # through this mask only ever writes the text's black pixels
+        label = PIL.Image.new('1', font.getbbox(text)[2:], 0)
+        ImageDraw.Draw(label).text((0, 0), text, font=font, fill=1)
+        return label
+
+    async def fetchBusJSON(self, baseURL, stopID, busLine):
+        """Fetch the JSON for a bus route at a bus stop"""
+        # aiohttp sessions must be created from inside the event loop
+        if not self.session:
+            timeout = aiohttp.ClientTimeout(total=20)
+            self.session = aiohttp.ClientSession(
+                timeout=timeout,
+                headers={"Accept": "application/json",
+                         "User-Agent": "pibus/1"})
 
-    def fetchBusJSON(self, baseURL, stopID):
-        """Fetch the JSON for a bus stop"""
         try:
-            url = "%s/StopPoint/%s/arrivals" % (baseURL, stopID)
-            self.logger.debug("Fetching: %s" % url)
-            result = self.session.get(url, timeout=20)
+            url = "%s/Line/%s/Arrivals/%s" % (baseURL, busLine, stopID)
+            self.logger.debug("Fetching: %s", url)
+            headers = {}
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.lastModified:
+                headers["If-Modified-Since"] = self.lastModified
+            async with self.session.get(url, headers=headers) as result:
+                if result.status == 304:
+                    self.logger.debug("Not modified since last fetch")
+                    return NOT_MODIFIED
+
+                jsonResult = orjson.loads(await result.read())
+                self.etag = result.headers.get("ETag")
+                self.lastModified = result.headers.get("Last-Modified")
         except Exception as e:
-            self.logger.error("fetchBusJSON error. Stop %s: %s" % (stopID, e))
+            self.logger.error("fetchBusJSON error. Stop %s: %s", stopID, e)
             return None
 
-        jsonResult = result.json()
-        self.logger.debug("Raw JSON: %s" % self.prettifyJSON(jsonResult))
+        # Only pay for re-serialising the JSON if it will actually be logged
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Raw JSON: %s", self.prettifyJSON(jsonResult))
 
         return jsonResult
 
-    def updateBusInfo(self):
+    async def updateBusInfo(self):
         """Update the bus information"""
-        rawJSON = self.fetchBusJSON(self.options.baseURL,
-                                    self.options.busStopID)
-        if not rawJSON:
+        rawJSON = await self.fetchBusJSON(self.options.baseURL,
+                                          self.options.busStopID,
+                                          self.options.busLine)
+        if rawJSON is NOT_MODIFIED:
+            self.lastFetchTime = time.strftime("%H:%M:%S %d/%m/%Y",
+                                               time.localtime())
+            return True
+
+        # Build the new list before publishing it, since renderBusInfo() may
+        # be reading the current one from another thread
+        currentJSON = None
+        if rawJSON:
+            try:
+                currentJSON = rawJSON
+                if __debug__:
+                    # TfL has already filtered by bus line, but double check
+                    busLine = self.options.busLine.lower()
+                    currentJSON = [busItem for busItem in currentJSON
+                                   if busItem["lineName"].lower() == busLine]
+                for busItem in currentJSON:
+                    # Parse the arrival time once here, rather than on every
+                    # render
+                    busItem["_dueTimestamp"] = parse_iso8601(
+                        busItem["expectedArrival"]).timestamp()
+            except Exception:
+                # Nothing awaits this task after startup, so an exception
+                # raised here would otherwise never be reported
+                self.logger.exception("updateBusInfo error. Stop %s",
+                                      self.options.busStopID)
+                currentJSON = None
+
+        if currentJSON is None:
             self.currentJSON = None
             self.lastFetchTime = -1
+            # Make sure the next fetch can't be answered with a 304, since
+            # we no longer have the data it would refer to
+            self.etag = None
+            self.lastModified = None
             return False
 
-        self.currentJSON = []
-        for busItem in rawJSON:
-            if busItem[u'lineName'].lower() == \
-               self.options.busLine.lower():
-                self.currentJSON.append(busItem)
+        self.currentJSON = currentJSON
 
         self.lastFetchTime = time.strftime("%H:%M:%S %d/%m/%Y",
                                            time.localtime())
@@ -139,90 +256,121 @@ class PiBus:
 
     def getTimes(self):
         """Fetch the number of minutes until each bus is due"""
-        if not self.currentJSON:
+        # This runs on the render thread, so only read currentJSON once in
+        # case updateBusInfo() replaces it in the meantime
+        currentJSON = self.currentJSON
+        if not currentJSON:
             return None
 
-        times = []
-
-        now = datetime.datetime.now(datetime.timezone.utc)
-        for bus in self.currentJSON:
-            due = iso8601.parse_date(bus["expectedArrival"])
-            dueDiff = due - now
-            minutesDue = divmod(dueDiff.total_seconds(), 60)[0]
-            times.append("%02d" % max(minutesDue, 0))
+        now = time.time()
+        times = [max(0, int((bus["_dueTimestamp"] - now) // 60))
+                 for bus in currentJSON]
 
+        # Sort numerically, so buses 100 or more minutes away sort correctly
         times.sort()
+        times = [f"{minutesDue:02d}" for minutesDue in times]
 
-        if len(times) == 0:
-            times.append("--")
-        if len(times) == 1:
-            times.append("--")
-        if len(times) == 2:
-            times.append("--")
+        if len(times) < 3:
+            times.extend(["--"] * (3 - len(times)))
 
         return times
 
+    async def tick(self):
+        """Fetch the bus information if it is stale, then render it"""
+        # Ticks are 10 seconds apart, but jitter can leave three of them
+        # just short of 30 seconds, so allow some slack to avoid skipping a
+        # fetch until the fourth
+        if (self.lastFetchAttempt is None or
+                time.monotonic() - self.lastFetchAttempt >= 25) and \
+           (not self.fetchTask or self.fetchTask.done()):
+            self.lastFetchAttempt = time.monotonic()
+            self.fetchTask = asyncio.ensure_future(self.updateBusInfo())
+
+        # Don't render "No data available" before the first fetch finishes
+        if self.lastFetchTime is None:
+            await self.fetchTask
+
+        # Render in a worker thread, so a fetch in progress can carry on
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.renderExecutor, self.renderBusInfo)
+
     def renderBusInfo(self):
         """Render the available bus information to the e-Ink display"""
-        # the first argument means we get a 1 bit depth
-        image = PIL.Image.new('1', self.panel.size, WHITE)
+        if not self.panel:
+            return
+
+        # Reuse the frame buffer rather than allocating a new one each time
+        image = self.image
+        image.paste(self.blankImage)
         draw = ImageDraw.Draw(image)
 
-        # Draw a box on the screen
-        draw.line(((0, 0), (self.panel.width, 0)), fill=BLACK, width=1)
-        draw.line(((0, 0), (0, self.panel.height)), fill=BLACK, width=1)
-        draw.line(((self.panel.width - 1, 0),
-                  (self.panel.width - 1, self.panel.height)),
-                  fill=BLACK, width=1)
-        draw.line(((0, self.panel.height - 1),
-                  (self.panel.width - 1, self.panel.height - 1)),
-                  fill=BLACK, width=1)
+        # Avoid repeated attribute lookups in the drawing code below
+        panel = self.panel
+        text = draw.text
+        paste = image.paste
 
         times = self.getTimes()
         if not times and not self.renderSuspended:
-            draw.text((0, 0), "No data available",
-                      font=self.fontMedium, fill=BLACK)
-            draw.text((0, 25),
-                      time.strftime("%H:%M:%S %d/%m/%Y",
-                                    time.localtime()),
-                      font=self.fontMedium, fill=BLACK)
-            self.panel.display(image)
-            self.panel.update()
+            fontMedium = self.fontMedium
+            text((0, 0), "No data available", font=fontMedium, fill=BLACK)
+            text((0, 25), time.strftime("%H:%M:%S %d/%m/%Y", time.localtime()),
+                 font=fontMedium, fill=BLACK)
+            panel.display(image)
+            panel.update()
+            self.swapImages()
+            self.partialErasure = 0
             self.renderSuspended = True
         elif not times:
             self.logger.debug("Skipping, rendering is suspended")
         else:
             self.renderSuspended = False
+            fontLarge = self.fontLarge
+            fetchedY = panel.height - 10
+
             # Divide up the box
-            draw.line(((self.panel.width * 0.66, 0),
-                      (self.panel.width * 0.66, self.panel.height)),
-                      fill=BLACK, width=1)
-            draw.line(((self.panel.width * 0.66, self.panel.height * 0.5),
-                      (self.panel.width, self.panel.height * 0.5)),
-                      fill=BLACK, width=1)
+            line = draw.line
+            for dividerLine in self.dividerLines:
+                line(dividerLine, fill=BLACK, width=1)
 
             # Render the times
-            draw.text((-3, 20), times[0], font=self.fontHuge, fill=BLACK)
-            draw.text((174, 10), times[1], font=self.fontLarge, fill=BLACK)
-            draw.text((174, 100), times[2], font=self.fontLarge, fill=BLACK)
+            text((-3, 20), times[0], font=self.fontHuge, fill=BLACK)
+            text((174, 10), times[1], font=fontLarge, fill=BLACK)
+            text((174, 100), times[2], font=fontLarge, fill=BLACK)
 
             # Render the bus route
-            draw.text((1, 0), self.options.busLine,
-                      font=self.fontTiny, fill=BLACK)
+            paste(BLACK, (1, 0), self.busLineLabel)
 
             # Render the time of last successful data fetch
-            draw.text((1, self.panel.height - 10),
-                      "Fetched: %s" % self.lastFetchTime,
-                      font=self.fontTiny, fill=BLACK)
-
-            self.panel.display(image)
+            paste(BLACK, (1, fetchedY), self.fetchedLabel)
+            text((1 + self.fetchedLabelWidth, fetchedY),
+                 str(self.lastFetchTime), font=self.fontTiny, fill=BLACK)
 
-            if self.partialCount >= 10:
-                self.panel.update()
-                self.partialCount = 0
+            if self.lastImage is None:
+                changedPixels = None
             else:
-                self.panel.partial_update()
-                self.partialCount += 1
+                changes = ImageChops.logical_xor(self.lastImage, image)
+                if not changes.getbbox():
+                    self.logger.debug("Skipping, nothing has changed")
+                    return
+                changedPixels = changes.histogram()[255]
+
+            panel.display(image)
+            self.swapImages()
+
+            if changedPixels is None or \
+               self.partialErasure + changedPixels >= \
+               EINK_PARTIAL_ERASURE_LIMIT:
+                panel.update()
+                self.partialErasure = 0
+            else:
+                panel.partial_update()
+                self.partialErasure += changedPixels
+
+    def swapImages(self):
+        """Keep the frame just displayed, and draw the next one elsewhere"""
+        self.image, self.lastImage = self.lastImage, self.image
+        if not self.image:
+            self.image = self.blankImage.copy()
 
     def dummyShowBusInfo(self):
         """blah"""
@@ -244,11 +392,17 @@ class PiBus:
 
 if __name__ == "__main__":  # pragma: no cover
     logging.basicConfig()
-    scheduler = BlockingScheduler()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    scheduler = AsyncIOScheduler(event_loop=loop)
     options = parse_options()
     pibus = PiBus(options, scheduler)
 
     try:
         scheduler.start()
+        loop.run_forever()
     except KeyboardInterrupt:
         pass
+    finally:
+        if pibus.session:
+            loop.run_until_complete(pibus.session.close())